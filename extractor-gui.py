@@ -3,12 +3,18 @@
 """Graphical webarchive extractor (requires Tkinter)."""
 
 import os
+import re
 import sys
+import time
 import threading
-import queue
-import optparse
+import multiprocessing
+
+from pathlib import Path
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 from glob import iglob
+from fnmatch import fnmatch
 
 from tkinter import *
 from tkinter.ttk import *
@@ -26,11 +32,41 @@ except (ImportError): webbrowser = None
 import webarchive
 
 
+# Delay in msec before polling the extractor thread's queue again
+# when no new data was available
+POLL_IDLE_MS = 5
+
+# Maximum number of queued items to process per polling cycle
+QUEUE_BATCH_SIZE = 64
+
+# Limits for how many finished resources the extractor thread will
+# accumulate, and for how long, before reporting them to the UI
+PROGRESS_BATCH_SIZE = 16
+PROGRESS_BATCH_SECS = 0.025
+
+# Queue length beyond which the extractor thread stops sending resource
+# names, which are purely cosmetic, until the UI catches up
+QUEUE_BACKLOG_LIMIT = 256
+
+# Regular expression matching glob wildcard characters
+RX_GLOB_MAGIC = re.compile(r"[*?[]")
+
+
 class ExtractorUI(Tk):
     """Extractor UI window."""
 
-    def __init__(self, archives=[]):
-        """Return a new ExtractorUI object."""
+    def __init__(self, archives=[], parallel=True):
+        """Return a new ExtractorUI object.
+
+        If parallel is True, multiple archives will be extracted
+        simultaneously in separate processes. In that case the progress
+        bar tracks all archives at once, and the label showing the name
+        of the resource being extracted is not updated, since the worker
+        processes don't report individual resources.
+
+        If extracting any archive fails, the others are canceled and the
+        error is reported right away.
+        """
 
         Tk.__init__(self)
         self.title("Webarchive Extractor")
@@ -39,11 +75,29 @@ class ExtractorUI(Tk):
 
         # Archives to process
         self._archives = archives
+        self._parallel = parallel
 
         # To communicate with the ExtractorThread
         self._processing = BooleanVar()
         self._queue = None
         self._canceler = None
+        self._thread = None
+
+        # Progress not yet displayed because the window was hidden
+        self._pending_archives_done = 0
+        self._pending_resources_done = 0
+
+        # Resources extracted so far from the current archive (or from all
+        # archives, if extracting in parallel)
+        #
+        # The resource progress bar is set to this absolute value rather
+        # than advanced with step(), which wraps around at the maximum.
+        # That matters in parallel mode, where the maximum grows as each
+        # archive starts and progress can briefly catch up with it.
+        self._resources_done = 0
+
+        # Where the most recent archive was extracted
+        self._output_path = None
 
         # Whether to open the extracted file after processing
         # (only applicable if we are extracting a single archive)
@@ -109,6 +163,9 @@ class ExtractorUI(Tk):
         for seq in "<Return>", "<Escape>", "<Control-w>", "<Control-q>":
             self.bind(seq, self.close_window)
 
+        # Catch up on progress updates skipped while the window was hidden
+        self.bind("<Map>", self._update_progress)
+
         # --------------------------------------------------------------------
 
         if not self._archives:
@@ -156,7 +213,14 @@ class ExtractorUI(Tk):
         if self._processing.get():
             # Cancel extraction
             self._canceler.set()
-            self.wait_variable(self._processing)
+
+            # Keep the UI responsive while the thread finishes
+            # (we save a reference because _extract_archives_cb() will
+            # clear self._thread once it sees the thread is done)
+            thread = self._thread
+            while thread.is_alive():
+                self.update()
+                thread.join(POLL_IDLE_MS / 1000)
 
         self.destroy()
 
@@ -173,54 +237,117 @@ class ExtractorUI(Tk):
         # Set the maximum archive extraction progress
         self._archive_progress.configure(maximum=len(self._archives))
 
+        # Reset the resource extraction progress
+        self._pending_resources_done = 0
+        self._resources_done = 0
+        self._resource_progress.configure(value=0)
+
         # Create a queue and canceler to communicate with the extractor thread
-        self._queue = queue.Queue()
+        # (we only ever poll this without blocking, so a plain deque is
+        # sufficient; its append() and popleft() are thread-safe)
+        self._queue = deque()
         self._canceler = threading.Event()
 
         # Create an ExtractorThread to extract the archives in the background
-        et = ExtractorThread(self._archives, self._queue, self._canceler)
+        et = self._thread = ExtractorThread(self._archives,
+                                            self._queue,
+                                            self._canceler,
+                                            self._parallel)
         et.start()
 
+        # Locating the web browser can be slow, so do it in the background
+        # while we extract; webbrowser caches the result for later use
+        if webbrowser and self._open_after_processing.get():
+            threading.Thread(target=_find_web_browser, daemon=True).start()
+
         # Start processing data from the queue
         self._processing.set(1)
         self._extract_archives_cb()
 
+    def _update_progress(self, event=None):
+        """Display pending progress updates.
+
+        Redrawing the progress bars is relatively expensive, so updates
+        are deferred while the window is minimized or otherwise hidden.
+        """
+
+        if self.state() == "iconic" or not self.winfo_viewable():
+            return
+
+        if self._pending_archives_done:
+            self._archive_progress.step(self._pending_archives_done)
+            self._pending_archives_done = 0
+
+        if self._pending_resources_done:
+            self._resources_done += self._pending_resources_done
+            self._resource_progress.configure(value=self._resources_done)
+            self._pending_resources_done = 0
+
     def _extract_archives_cb(self):
         """Process data from the queue."""
 
-        if not self._queue:
+        if self._queue is None:
             return
 
-        # Timeout in msec before resuming the loop
-        timeout = 20
+        # Whether we received any messages this cycle
+        received = False
         error_occurred = False
 
-        try:
-            item = self._queue.get_nowait()
+        # Process a batch of items at a time, coalescing updates so we
+        # only reconfigure each widget once per batch
+        archive_label = None
+        resource_label = None
+
+        for i in range(QUEUE_BATCH_SIZE):
+            try:
+                item = self._queue.popleft()
+            except (IndexError):
+                # Still waiting for the next item
+                break
 
             if item is None:
                 # Done processing
                 self._processing.set(0)
+                break
 
             elif isinstance(item, Exception):
                 # Halt processing and display the error message
                 self._processing.set(0)
                 showerror("Error", item, parent=self)
                 error_occurred = True
+                break
 
             elif isinstance(item, tuple):
                 # Interpret the message from the archive thread
                 command, payload = item
-                timeout = 0
+                received = True
 
                 if command == "archive start":
+                    # The payload is the archive name and resource count
+                    archive_base, resource_count = payload
+
                     # Display the archive name
-                    label = "Archive: {0}".format(payload)
-                    self._archive_name.configure(text=label)
+                    archive_label = "Archive: {0}".format(archive_base)
+
+                    # Reset the resource extraction progress for this
+                    # archive (the count is None if extracting archives in
+                    # parallel, where we instead get "resource count"
+                    # messages with the total for all archives)
+                    if resource_count is not None:
+                        self._pending_resources_done = 0
+                        self._resources_done = 0
+                        self._resource_progress.configure(
+                            value=0,
+                            maximum=resource_count
+                        )
 
                 elif command == "archive done":
                     # Increment the archive extraction progress
-                    self._archive_progress.step()
+                    self._pending_archives_done += 1
+
+                elif command == "output path":
+                    # Remember where this archive is being extracted
+                    self._output_path = payload
 
                 elif command == "resource count":
                     # Set the maximum resource extraction progress
@@ -228,20 +355,27 @@ class ExtractorUI(Tk):
 
                 elif command == "resource start":
                     # Display the resource name
-                    label = "Extracting: {0}".format(payload)
-                    self._resource_name.configure(text=label)
+                    resource_label = "Extracting: {0}".format(payload)
 
                 elif command == "resource done":
                     # Increment the resource extraction progress
-                    self._resource_progress.step()
+                    # (the payload is the number of resources completed)
+                    self._pending_resources_done += payload
 
-        except (queue.Empty):
-            # Still waiting for the next item
-            pass
+        if archive_label is not None:
+            self._archive_name.configure(text=archive_label)
+        if resource_label is not None:
+            self._resource_name.configure(text=resource_label)
+        self._update_progress()
 
         if self._processing.get():
-            # Continue the loop until we're told to stop
-            self.after(timeout, self._extract_archives_cb)
+            # Continue the loop until we're told to stop. If messages are
+            # arriving, resume as soon as Tk is idle; otherwise wait a bit
+            # so we don't spin while the extractor thread is busy.
+            if received:
+                self.after_idle(self._extract_archives_cb)
+            else:
+                self.after(POLL_IDLE_MS, self._extract_archives_cb)
 
         else:
             # Clean up
@@ -249,38 +383,59 @@ class ExtractorUI(Tk):
             del self._canceler
             self._queue = None
             self._canceler = None
+            self._thread = None
 
             if (not error_occurred
                 and webbrowser
+                and self._output_path
                 and self._open_after_processing.get()):
-                # Figure out where we extracted this archive
-                # FIXME: Duplicated from ExtractorThread.run()
-                base, ext = os.path.splitext(self._archives[0])
-                output_path = "{0}.html".format(base)
-
                 # Open the extracted page
-                webbrowser.open(output_path)
+                output_url = Path(self._output_path).absolute().as_uri()
+                webbrowser.open_new_tab(output_url)
 
             # Close the window
-            self.after(20, self.close_window)
+            self.after(POLL_IDLE_MS, self.close_window)
 
 
 class ExtractorThread(threading.Thread):
     """Webarchive extraction thread."""
 
-    def __init__(self, archives, queue, canceler):
-        """Return a new ExtractorThread object."""
+    def __init__(self, archives, queue, canceler, parallel=False):
+        """Return a new ExtractorThread object.
+
+        If parallel is True and there is more than one archive, the
+        archives will be extracted simultaneously using a pool of worker
+        processes, with this thread relaying their progress to the UI.
+        Workers report only per-archive and finished-resource counts, not
+        "resource start" messages. If any worker fails, the rest are
+        canceled and its exception is passed to the UI.
+        """
 
         threading.Thread.__init__(self)
 
+        # Don't keep the process alive if the UI exits unexpectedly
+        self.daemon = True
+
         self._archives = archives
         self._queue = queue
         self._canceler = canceler
+        self._parallel = parallel
+
+        # Finished resources not yet reported to the UI
+        self._pending_done = 0
+        self._last_flush = time.monotonic()
+
+        # Name of the last resource reported to the UI
+        self._last_resource_base = None
 
     def run(self):
         """Extract the webarchives."""
 
         try:
+            if self._parallel and len(self._archives) > 1:
+                self._run_parallel()
+                return
+
             for archive_path in self._archives:
                 if self._canceler.is_set():
                     break
@@ -289,53 +444,244 @@ class ExtractorThread(threading.Thread):
                     archive_base = os.path.basename(archive_path)
 
                     # Pass some information about the archive back to the UI
-                    self._queue.put(("archive start", archive_base))
-                    self._queue.put(("resource count",
-                                     archive.resource_count()))
+                    self._queue.append(("archive start",
+                                        (archive_base,
+                                         archive.resource_count())))
 
                     # Derive the output path from the archive path
                     base, ext = os.path.splitext(archive_path)
                     output_path = "{0}.html".format(base)
+                    self._queue.append(("output path", output_path))
 
                     # Extract the archive
                     archive.extract(output_path,
                                     before_cb=self._before_cb,
                                     after_cb=self._after_cb,
                                     canceled_cb=self._canceler.is_set)
-                    self._queue.put(("archive done", archive_base))
+                    self._flush_progress()
+                    self._queue.append(("archive done", archive_base))
 
             # Signal we are done processing
-            self._queue.put(None)
+            self._queue.append(None)
 
         except (Exception) as err:
             # Pass the exception back to the UI thread
-            self._queue.put(err)
+            self._queue.append(err)
+
+    def _run_parallel(self):
+        """Extract the webarchives using a pool of worker processes."""
+
+        # Total resources in the archives the workers have opened so far
+        resource_count = 0
+
+        def relay_messages():
+            # Forward messages from the workers to the UI
+            nonlocal resource_count
+            while not mp_queue.empty():
+                command, payload = mp_queue.get()
+                if command == "archive start":
+                    # The resource progress bar tracks all archives at once
+                    archive_base, archive_resource_count = payload
+                    resource_count += archive_resource_count
+                    self._queue.append(("archive start", (archive_base, None)))
+                    self._queue.append(("resource count", resource_count))
+                else:
+                    self._queue.append((command, payload))
+
+        max_workers = min(len(self._archives), os.cpu_count() or 1)
+
+        # Always start fresh worker processes rather than forking, since
+        # forking a process with other threads running (like the UI's)
+        # can deadlock the child
+        mp_context = multiprocessing.get_context("spawn")
+
+        with mp_context.Manager() as manager:
+            mp_queue = manager.Queue()
+            mp_canceler = manager.Event()
+
+            with ProcessPoolExecutor(max_workers=max_workers,
+                                     mp_context=mp_context) as executor:
+                futures = [executor.submit(_extract_archive_process,
+                                           archive_path,
+                                           mp_queue,
+                                           mp_canceler)
+                           for archive_path in self._archives]
+
+                pending = futures
+                failed = False
+                while pending:
+                    if failed or self._canceler.is_set():
+                        # Stop the other workers, too, if one of them
+                        # failed, so its error is reported promptly
+                        # rather than after every other archive is done
+                        mp_canceler.set()
+                        for future in pending:
+                            future.cancel()
+
+                    done, pending = wait(pending,
+                                         timeout=POLL_IDLE_MS / 1000,
+                                         return_when=FIRST_COMPLETED)
+                    relay_messages()
+
+                    for future in done:
+                        if (not future.cancelled()
+                            and future.exception() is not None):
+                            failed = True
+
+                relay_messages()
+
+            # Raise the first exception any worker encountered
+            for future in futures:
+                if not future.cancelled():
+                    future.result()
+
+        # Signal we are done processing
+        self._queue.append(None)
 
     def _before_cb(self, res, output_path):
         """Callback before extracting a WebResource from an archive."""
 
-        output_base = os.path.basename(output_path)
-        self._queue.put(("resource start", output_base))
+        if len(self._queue) >= QUEUE_BACKLOG_LIMIT:
+            # The UI is falling behind, so skip this update
+            return
+
+        # Archive paths are normalized and resource paths are built with
+        # os.path.join(), so this is cheaper than os.path.basename()
+        output_base = output_path.rpartition(os.sep)[2]
+        if output_base != self._last_resource_base:
+            self._queue.append(("resource start", output_base))
+            self._last_resource_base = output_base
 
     def _after_cb(self, res, output_path):
         """Callback after extracting a WebResource from an archive."""
 
-        self._queue.put(("resource done", None))
+        self._pending_done += 1
+
+        # Report progress in batches to avoid flooding the UI with updates
+        if (self._pending_done >= PROGRESS_BATCH_SIZE
+            or time.monotonic() - self._last_flush >= PROGRESS_BATCH_SECS):
+            self._flush_progress()
+
+    def _flush_progress(self):
+        """Report any finished resources to the UI."""
+
+        if self._pending_done:
+            self._queue.append(("resource done", self._pending_done))
+            self._pending_done = 0
+
+        self._last_flush = time.monotonic()
+
+
+def _extract_archive_process(archive_path, queue, canceler):
+    """Extract a single webarchive in a worker process.
+
+    This is used by ExtractorThread when extracting archives in parallel.
+    Progress is reported as (command, payload) tuples on the specified
+    multiprocessing queue. Since this is a separate process, messages are
+    sent sparingly; individual resource names are not reported at all.
+    """
+
+    pending_done = 0
+
+    def after_cb(res, output_path):
+        nonlocal pending_done
+        pending_done += 1
+        if pending_done >= PROGRESS_BATCH_SIZE:
+            queue.put(("resource done", pending_done))
+            pending_done = 0
+
+    if canceler.is_set():
+        return
+
+    with webarchive.open(archive_path) as archive:
+        archive_base = os.path.basename(archive_path)
+
+        queue.put(("archive start", (archive_base, archive.resource_count())))
+
+        # Derive the output path from the archive path
+        base, ext = os.path.splitext(archive_path)
+        output_path = "{0}.html".format(base)
+        queue.put(("output path", output_path))
+
+        # Extract the archive
+        archive.extract(output_path,
+                        after_cb=after_cb,
+                        canceled_cb=canceler.is_set)
+
+        if pending_done:
+            queue.put(("resource done", pending_done))
+        queue.put(("archive done", archive_base))
+
+
+def _find_web_browser():
+    """Locate the user's web browser so webbrowser.open() is fast later."""
+
+    try:
+        webbrowser.get()
+    except (webbrowser.Error):
+        # No browser available; webbrowser.open() will handle this
+        pass
+
+
+def _expand_wildcards(arg):
+    """Yield the paths matching a command-line argument.
+
+    This handles the common cases -- a literal path, or a wildcard in the
+    last path component -- with a single directory scan, and falls back
+    on glob for anything more complicated.
+    """
+
+    if not RX_GLOB_MAGIC.search(arg):
+        # Literal path; as with glob, only yield it if it exists
+        if os.path.lexists(arg):
+            yield arg
+        return
+
+    dirname, pattern = os.path.split(arg)
+    if RX_GLOB_MAGIC.search(dirname):
+        yield from iglob(arg)
+        return
+
+    try:
+        with os.scandir(dirname or os.curdir) as entries:
+            for entry in entries:
+                # Like glob, hide dotfiles unless the pattern starts with "."
+                if entry.name.startswith(".") and not pattern.startswith("."):
+                    continue
+                if fnmatch(entry.name, pattern):
+                    yield os.path.join(dirname, entry.name)
+
+    except (OSError):
+        # Nonexistent or unreadable directory; there is nothing to match
+        pass
 
 
 if __name__ == "__main__":
-    parser = optparse.OptionParser(
-        usage="%prog [options] input_path.webarchive [another.webarchive ...]",
-        version="pywebarchive {0}".format(webarchive.__version__)
+    # Needed for worker processes in the frozen Windows build
+    multiprocessing.freeze_support()
+
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        usage="%(prog)s [options] input_path.webarchive "
+              "[another.webarchive ...]"
     )
+    parser.add_argument("--version", action="version",
+                        version="pywebarchive {0}"
+                                .format(webarchive.__version__))
+    parser.add_argument("--serial",
+                        action="store_false", dest="parallel",
+                        help="extract archives one at a time instead of "
+                             "in parallel")
+    parser.add_argument("paths", nargs="*", help=argparse.SUPPRESS)
 
-    options, args = parser.parse_args()
+    options = parser.parse_args()
 
     # Look for archives on the command line
     # If no archives are specified, ExtractorUI will display a browse dialog.
     archives = []
-    for arg in args:
-        archives += iglob(arg)
+    for arg in options.paths:
+        archives += map(os.path.normpath, _expand_wildcards(arg))
 
-    ui = ExtractorUI(archives)
+    ui = ExtractorUI(archives, options.parallel)
     ui.mainloop()
@@ -4,7 +4,6 @@
 
 import os
 import sys
-import optparse
 
 # webbrowser is useful, but we can live without it
 try: import webbrowser
@@ -16,27 +15,34 @@ import webarchive
 def main():
     """Extract the .webarchive file specified on the command line."""
 
-    parser = optparse.OptionParser(
-        usage="%prog [options] input_path.webarchive [output_path.html]",
-        version="pywebarchive {0}".format(webarchive.__version__)
-    )
+    import argparse
 
-    opt_group = parser.add_option_group("Extraction mode")
-    opt_group.add_option("-s", "--single-file",
-                         action="store_true", dest="single_file",
-                         help="single file mode; embeds the page's non-HTML "
-                              "content using data URIs. "
-                              "This is usually slower and less efficient "
-                              "than extracting such content to separate "
-                              "files, so only use this if you know what "
-                              "you're doing!")
-
-    opt_group = parser.add_option_group("Post-processing actions")
-    opt_group.add_option("-o", "--open-page",
-                         action="store_true", dest="open_page",
-                         help="open the extracted webpage when finished")
-
-    options, args = parser.parse_args()
+    parser = argparse.ArgumentParser(
+        usage="%(prog)s [options] input_path.webarchive [output_path.html]"
+    )
+    parser.add_argument("--version", action="version",
+                        version="pywebarchive {0}"
+                                .format(webarchive.__version__))
+
+    arg_group = parser.add_argument_group("Extraction mode")
+    arg_group.add_argument("-s", "--single-file",
+                           action="store_true", dest="single_file",
+                           help="single file mode; embeds the page's "
+                                "non-HTML content using data URIs. "
+                                "This is usually slower and less efficient "
+                                "than extracting such content to separate "
+                                "files, so only use this if you know what "
+                                "you're doing!")
+
+    arg_group = parser.add_argument_group("Post-processing actions")
+    arg_group.add_argument("-o", "--open-page",
+                           action="store_true", dest="open_page",
+                           help="open the extracted webpage when finished")
+
+    parser.add_argument("paths", nargs="*", help=argparse.SUPPRESS)
+
+    options = parser.parse_args()
+    args = options.paths
     if len(args) == 1:
         # Get the archive path from the command line
         archive_path = args[0]
@@ -1,35 +0,0 @@
-#!/usr/bin/env python3
-
-from setuptools import setup, find_packages
-from webarchive import __version__
-
-NAME = "pywebarchive"
-VERSION = __version__
-AUTHOR = "Benjamin Johnson"
-AUTHOR_EMAIL = "bmjcode@gmail.com"
-DESCRIPTION = "Module for reading Apple's webarchive format"
-
-with open("README.md", "r") as readme:
-    LONG_DESCRIPTION = readme.read()
-
-URL = "https://github.com/bmjcode/pywebarchive"
-PACKAGES = find_packages(exclude="test")
-CLASSIFIERS = [
-    "Development Status :: 5 - Production/Stable",
-    "Development Status :: 6 - Mature",
-    "Development Status :: 7 - Inactive",
-    "Programming Language :: Python :: 3",
-    "License :: OSI Approved :: MIT License",
-    "Operating System :: OS Independent",
-]
-
-setup(name=NAME,
-      version=VERSION,
-      author=AUTHOR,
-      author_email=AUTHOR_EMAIL,
-      description=DESCRIPTION,
-      long_description=LONG_DESCRIPTION,
-      long_description_content_type="text/markdown",
-      url=URL,
-      packages=PACKAGES,
-      classifiers=CLASSIFIERS)
@@ -12,7 +12,6 @@ import sys
 import tempfile
 import webbrowser
 import textwrap
-import time
 
 # Absolute path to this source file
 # (we need this for the webarchive import)
@@ -51,11 +50,14 @@ def run_test():
         print(textwrap.dedent("""\
             If the archive extracted correctly, your web browser should
             display the main page of the English Wikipedia with a featured
-            article on P. G. Wodehouse."""))
-
-        # Wait a few seconds for the browser to open and finish rendering
-        # before we clean up the temporary directory
-        time.sleep(10)
+            article on P. G. Wodehouse.
+            """))
+
+        # Wait for the user to check the page before we clean up the
+        # temporary directory. This is better than sleeping for a fixed
+        # time, which is too long if the browser is quick and too short
+        # if it isn't.
+        input("Press Enter to clean up and exit.")
 
 
 if __name__ == "__main__":
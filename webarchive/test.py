@@ -9,12 +9,14 @@
 
 import os
 import io
+import copy
 import tempfile
 import unittest
 
 from . import (open as open_webarchive,
                WebArchive, WebArchiveError, WebResource)
-from .util import HTMLRewriter, is_html_mime_type, process_css_resource
+from .util import (HTMLRewriter, escape_attr_value, is_html_mime_type,
+                   process_css_resource, process_html_resource)
 
 
 # Absolute path to this file
@@ -28,20 +30,33 @@ SAMPLE_DATA_DIR = os.path.join(os.path.dirname(TEST_PY_PATH), "sample_data")
 SAMPLE_ARCHIVE_PATH = os.path.join(SAMPLE_DATA_DIR, "Wikipedia.webarchive")
 
 
-class WebArchiveTest(unittest.TestCase):
-    """Test case for the WebArchive class."""
+class SampleArchiveTest(unittest.TestCase):
+    """Base class for test cases using our sample archive."""
+
+    @classmethod
+    def setUpClass(cls):
+        """Set up the test class."""
+
+        # Load our sample archive once for all tests in this class
+        #
+        # Tests that modify the archive should work on a copy; see
+        # test_webarchive_local_paths() for an example.
+        cls._sample_archive = open_webarchive(SAMPLE_ARCHIVE_PATH)
 
     def setUp(self):
         """Set up the test case."""
 
-        # Load our sample archive
-        self.archive = open_webarchive(SAMPLE_ARCHIVE_PATH)
+        self.archive = self._sample_archive
 
     def tearDown(self):
         """Clean up the test case."""
 
         pass
 
+
+class WebArchiveTest(SampleArchiveTest):
+    """Test case for the WebArchive class."""
+
     def test_webarchive_context_manager(self):
         """Test the WebArchive's class context manager."""
 
@@ -64,6 +79,24 @@ class WebArchiveTest(unittest.TestCase):
         self.assertFalse(is_html_mime_type("text/css"))
         self.assertFalse(is_html_mime_type("text/javascript"))
 
+    def test_escape_attr_value(self):
+        """Test the escape_attr_value() method."""
+
+        # Quotes and other special characters should be escaped
+        value = '<"Tom" & \'Jerry\'>'
+        escaped = "&lt;&quot;Tom&quot; &amp; &#x27;Jerry&#x27;&gt;"
+        self.assertEqual(escape_attr_value(value), escaped)
+
+        # Repeated calls should give the same result
+        self.assertEqual(escape_attr_value(value), escaped)
+
+        # Long values, which are not cached, should work the same way
+        self.assertEqual(escape_attr_value(value * 100), escaped * 100)
+
+        # Values without special characters should be returned as-is
+        value = "mw-body-content"
+        self.assertIs(escape_attr_value(value), value)
+
     def test_webarchive_properties(self):
         """Test WebArchive object properties."""
 
@@ -105,8 +138,7 @@ class WebArchiveTest(unittest.TestCase):
 
         # Assert that WebResource properties return the expected values
         # for this sample archive
-        data_str = "".join(map(chr, resource.data))
-        self.assertTrue(data_str.startswith("<!DOCTYPE html>"))
+        self.assertTrue(resource.data.startswith(b"<!DOCTYPE html>"))
         self.assertEqual(resource.frame_name, "")
         self.assertEqual(resource.mime_type, "text/html")
         self.assertEqual(resource.text_encoding, "utf-8")
@@ -190,9 +222,69 @@ class WebArchiveTest(unittest.TestCase):
 
             # Assert that the output directory contains the expected number
             # of files (the archive's resource count, minus the main resource)
-            output_dir_contents = os.listdir(output_dir)
-            self.assertEqual(len(output_dir_contents),
-                             self.archive.resource_count() - 1)
+            with os.scandir(output_dir) as entries:
+                file_count = sum(1 for entry in entries)
+            self.assertEqual(file_count, self.archive.resource_count() - 1)
+
+    def test_webarchive_extraction_callbacks(self):
+        """Test the callbacks for monitoring WebArchive extraction."""
+
+        events = []
+
+        def before_cb(res, path):
+            events.append(("before", res.url))
+
+        def after_cb(res, path):
+            # The resource should already have been written
+            self.assertTrue(os.path.isfile(path))
+            events.append(("after", res.url))
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output_path = os.path.join(tmp_dir, "Wikipedia.html")
+            self.archive.extract(output_path,
+                                 before_cb=before_cb,
+                                 after_cb=after_cb)
+
+        # Each resource should be reported exactly once before and after
+        resource_count = self.archive.resource_count()
+        befores = [url for event, url in events if event == "before"]
+        afters = [url for event, url in events if event == "after"]
+        self.assertEqual(len(befores), resource_count)
+        self.assertEqual(befores, afters)
+
+        # And "after" should never come before the matching "before"
+        for url in afters:
+            self.assertLess(events.index(("before", url)),
+                            events.index(("after", url)))
+
+    def test_webarchive_extraction_canceled(self):
+        """Test canceling WebArchive extraction."""
+
+        before_count = 0
+        after_count = 0
+
+        def before_cb(res, path):
+            nonlocal before_count
+            before_count += 1
+
+        def after_cb(res, path):
+            nonlocal after_count
+            after_count += 1
+
+        def canceled_cb():
+            # Cancel after starting a few resources
+            return before_count >= 3
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output_path = os.path.join(tmp_dir, "Wikipedia.html")
+            self.archive.extract(output_path,
+                                 before_cb=before_cb,
+                                 after_cb=after_cb,
+                                 canceled_cb=canceled_cb)
+
+        # Resources already started should still be finished
+        self.assertEqual(before_count, 3)
+        self.assertEqual(after_count, 3)
 
     def test_webarchive_to_html(self):
         """Test the WebArchive.to_html() method."""
@@ -213,6 +305,91 @@ class WebArchiveTest(unittest.TestCase):
 
             self.assertEqual(self.archive.to_html(), content)
 
+    def test_webarchive_local_paths(self):
+        """Test that WebArchive local paths are unique."""
+
+        # Work on a copy, since this test adds a local path
+        archive = copy.deepcopy(self.archive)
+
+        local_paths = list(archive._local_paths.values())
+        self.assertEqual(len(local_paths), len(set(local_paths)))
+        self.assertEqual(set(local_paths), archive._used_local_paths)
+
+        # Adding a resource with a duplicate basename should not reuse
+        # an existing local path
+        res = WebResource(archive,
+                          b"",
+                          archive.main_resource.mime_type,
+                          "https://www.example.com/wiki/Main_Page")
+        local_path = archive._make_local_path(res)
+        self.assertNotIn(local_path, local_paths)
+
+    def test_webarchive_local_path_basenames(self):
+        """Test deriving local path basenames from URLs."""
+
+        archive = WebArchive()
+        for url, local_path in (
+            ("https://www.example.com/images/photo.jpg?w=100#top",
+             "photo.png"),
+            ("https://www.example.com/archive.tar.gz", "archive.tar.png"),
+            ("https://www.example.com/page.jsp;jsessionid=1", "page.png"),
+            ("https://www.example.com/.hidden", ".hidden.png"),
+            ("https://www.example.com/", "blank_url.png"),
+            ("data:image/png;base64,", "data_url.png"),
+        ):
+            res = WebResource(archive, b"", "image/png", url)
+            self.assertEqual(archive._make_local_path(res), local_path)
+
+    def test_webarchive_local_path_extensions(self):
+        """Test that local paths use common extensions for web content."""
+
+        # Work on a copy, since this test adds local paths
+        archive = copy.deepcopy(self.archive)
+
+        for mime_type, ext in (("text/javascript", ".js"),
+                               ("application/x-javascript", ".js"),
+                               ("font/woff2", ".woff2")):
+            res = WebResource(archive,
+                              b"",
+                              mime_type,
+                              "https://www.example.com/load.php")
+            local_path = archive._make_local_path(res)
+            self.assertTrue(local_path.endswith(ext))
+
+    def test_webarchive_absolute_url(self):
+        """Test resolving absolute URLs with WebArchive._get_absolute_url()."""
+
+        rel_url = "/wiki/P._G._Wodehouse"
+        abs_url = "https://en.wikipedia.org/wiki/P._G._Wodehouse"
+
+        # Relative URLs are resolved from the main resource's URL
+        self.assertEqual(self.archive._get_absolute_url(rel_url), abs_url)
+
+        # Repeated lookups should give the same (cached) result
+        self.assertIn((self.archive.main_resource.url, rel_url),
+                      self.archive._absolute_urls)
+        self.assertEqual(self.archive._get_absolute_url(rel_url), abs_url)
+
+        # An alternative base is not confused with the cached result
+        self.assertEqual(
+            self.archive._get_absolute_url(rel_url, "https://example.com/"),
+            "https://example.com/wiki/P._G._Wodehouse"
+        )
+
+    def test_webarchive_get_subresource(self):
+        """Test looking up subresources by URL."""
+
+        for res in self.archive.subresources:
+            self.assertIs(self.archive.get_subresource(res.url), res)
+
+        # URLs not in this archive should raise an exception
+        with self.assertRaises(WebArchiveError):
+            self.archive.get_subresource("https://www.example.com/")
+
+        # So should relative URLs
+        with self.assertRaises(WebArchiveError):
+            self.archive.get_subresource("/static/favicon/wikipedia.ico")
+
     def test_webarchive_parent(self):
         """Test the WebArchive.parent property."""
 
@@ -241,80 +418,87 @@ class MalformedArchiveTest(unittest.TestCase):
         self.assertEqual(archive.resource_count(), 0)
 
         # Attempting to extract this archive should raise an exception
+        # before anything is written, so the output path doesn't matter
+        # (if it did, the directory's absence would raise a different one)
+        output_path = os.path.join(SAMPLE_DATA_DIR, "nonexistent",
+                                   "output.html")
         with self.assertRaises(WebArchiveError):
-            with tempfile.TemporaryDirectory() as tmp_dir:
-                output_path = os.path.join(tmp_dir, "output.html")
-                archive.extract(output_path)
+            archive.extract(output_path)
+        with self.assertRaises(WebArchiveError):
+            archive.extract(output_path, True)
 
         # Attempting to convert it to HTML should also raise an exception
         with self.assertRaises(WebArchiveError):
             archive.to_html()
 
 
-class RewriterTest(WebArchiveTest):
+class RewriterTest(SampleArchiveTest):
     """Base class for HTML and CSS rewriter tests."""
 
-    def setUp(self):
-        """Set up the test case."""
+    @classmethod
+    def setUpClass(cls):
+        """Set up the test class."""
 
-        WebArchiveTest.setUp(self)
-        abs_url = self.archive._get_absolute_url
+        super().setUpClass()
+        archive = cls._sample_archive
+        abs_url = archive._get_absolute_url
+
+        # URLs of all subresources in this archive
+        cls.subresource_urls = frozenset(
+            (res.url for res in archive.subresources)
+        )
 
         # URL of some page not within this archive
-        self.external_url = "https://www.example.com/"
+        cls.external_url = "https://www.example.com/"
 
         # Relative URL of some page not within this archive
-        self.rel_external_url = "/wiki/P._G._Wodehouse"
+        cls.rel_external_url = "/wiki/P._G._Wodehouse"
+
+        # Absolute URL for the above page
+        cls.abs_external_url = abs_url(cls.rel_external_url)
 
         # URL of some (arbitrary) subresource within this archive
-        self.subresource_url = (
+        cls.subresource_url = (
             "https://upload.wikimedia.org/wikipedia/commons"
             "/thumb/0/08/Kinewell_Lake_4.jpg/125px-Kinewell_Lake_4.jpg"
         )
 
         # Local path for the above subresource
-        self.subresource_local_path = "/".join((
+        cls.subresource_local_path = "/".join((
             "TestArchive_files",
-            self.archive.get_local_path(self.subresource_url)
+            archive.get_local_path(cls.subresource_url)
         ))
 
         # Relative URL of another subresource
         # Also arbitrary, so long as it's on the same server
-        self.rel_subresource_url = (
+        cls.rel_subresource_url = (
             "/static/images/poweredby_mediawiki_88x31.png"
         )
 
         # Local path for the above subresource
-        self.rel_subresource_local_path = "/".join((
+        cls.rel_subresource_local_path = "/".join((
             "TestArchive_files",
-            self.archive.get_local_path(abs_url(self.rel_subresource_url))
+            archive.get_local_path(abs_url(cls.rel_subresource_url))
         ))
 
     def tearDown(self):
         """Clean up the test case."""
 
-        WebArchiveTest.tearDown(self)
+        SampleArchiveTest.tearDown(self)
 
     def test_internal_urls(self):
         """Internal sanity checks on our various sample URLs."""
 
         abs_url = self.archive._get_absolute_url
 
-        def have_subresource(url):
-            for res in self.archive.subresources:
-                if res.url == url:
-                    return True
-            else:
-                return False
-
         # Make sure external URLs are actually external
-        for res in self.archive.subresources:
-            self.assertNotEqual(res.url, self.external_url)
-            self.assertNotEqual(res.url, abs_url(self.rel_external_url))
+        self.assertNotIn(self.external_url, self.subresource_urls)
+        self.assertNotIn(self.abs_external_url, self.subresource_urls)
 
         # Make sure subresource URLs are actually subresources
-        self.assertTrue(have_subresource(self.subresource_url))
-        self.assertTrue(have_subresource(abs_url(self.rel_subresource_url)))
+        self.assertIn(self.subresource_url, self.subresource_urls)
+        self.assertIn(abs_url(self.rel_subresource_url),
+                      self.subresource_urls)
 
 
 class HTMLRewriterTest(RewriterTest):
@@ -324,7 +508,6 @@ class HTMLRewriterTest(RewriterTest):
         """Set up the test case."""
 
         RewriterTest.setUp(self)
-        abs_url = self.archive._get_absolute_url
 
         # Create an output stream and HTML rewriter
         self.output = io.StringIO()
@@ -359,9 +542,7 @@ class HTMLRewriterTest(RewriterTest):
         # Relative URLs should be rewritten as absolute URLs
         template = '<a href="{0}">'
         in_value = template.format(self.rel_external_url)
-        out_value = template.format(
-            self.archive._get_absolute_url(self.rel_external_url)
-        )
+        out_value = template.format(self.abs_external_url)
         self.assertNotEqual(in_value, out_value)
 
         self.rewriter.feed(in_value)
@@ -439,6 +620,44 @@ class HTMLRewriterTest(RewriterTest):
         self.rewriter.feed(in_value)
         self.assertEqual(self.output.getvalue(), out_value)
 
+    def test_img_src_repeated(self):
+        """Test <img src="..."> with the same URL used more than once."""
+
+        template = '<img src="{0}"><img src="{0}">'
+        in_value = template.format(self.rel_subresource_url)
+        out_value = template.format(self.rel_subresource_local_path)
+
+        self.rewriter.feed(in_value)
+        self.assertEqual(self.output.getvalue(), out_value)
+        self.assertIn(self.rel_subresource_url, self.rewriter._resource_urls)
+
+    def test_img_srcset(self):
+        """Test <img srcset="..."> with multiple image candidates."""
+
+        template = '<img srcset="{0} 1x, {1}, {2} 2x">'
+        in_value = template.format(self.subresource_url,
+                                   self.external_url,
+                                   self.rel_subresource_url)
+        out_value = template.format(self.subresource_local_path,
+                                    self.external_url,
+                                    self.rel_subresource_local_path)
+        self.assertNotEqual(in_value, out_value)
+
+        self.rewriter.feed(in_value)
+        self.assertEqual(self.output.getvalue(), out_value)
+
+    def test_img_srcset_data_url(self):
+        """Test <img srcset="..."> with a data URL containing a comma."""
+
+        template = '<img srcset="{0} 1x, {1} 2x">'
+        data_url = "data:image/png;base64,iVBORw0KGgo="
+        in_value = template.format(data_url, self.rel_subresource_url)
+        out_value = template.format(data_url,
+                                    self.rel_subresource_local_path)
+
+        self.rewriter.feed(in_value)
+        self.assertEqual(self.output.getvalue(), out_value)
+
     def test_style_subresource(self):
         """Test inline <style> with a subresource URL."""
 
@@ -461,6 +680,17 @@ class HTMLRewriterTest(RewriterTest):
         self.rewriter.feed(in_value)
         self.assertEqual(self.output.getvalue(), out_value)
 
+    def test_close_flushes_output(self):
+        """Test that closing the rewriter writes out trailing input."""
+
+        # HTMLParser holds back the incomplete entity reference until
+        # close() is called, so it only reaches the output then
+        in_value = "<p>hello &amp"
+
+        self.rewriter.feed(in_value)
+        self.rewriter.close()
+        self.assertEqual(self.output.getvalue(), in_value)
+
     def test_xhtml_void_elements(self):
         """Test handling of self-closing XHTML tags like <img />."""
 
@@ -529,23 +759,54 @@ class HTMLRewriterTest(RewriterTest):
         self.rewriter.feed(in_value)
         self.assertEqual(self.output.getvalue(), out_value)
 
+    def test_process_without_urls(self):
+        """Test that HTML without URLs is passed through unchanged."""
+
+        # HTMLRewriter would normalize the attribute's quotes and case,
+        # so this confirms the document was not parsed at all
+        in_value = "<p CLASS=note>Nothing to rewrite here</p>"
+
+        res = WebResource(self.archive,
+                          in_value,
+                          "text/html",
+                          self.archive.main_resource.url)
+        process_html_resource(res, self.output, "TestArchive_files")
+        self.assertEqual(self.output.getvalue(), in_value)
+
+    def test_process_with_urls(self):
+        """Test that HTML with URLs is still rewritten."""
+
+        template = '<p CLASS=note><img src="{0}"></p>'
+        in_value = template.format(self.rel_subresource_url)
+        out_value = '<p class="note"><img src="{0}"></p>'.format(
+            self.rel_subresource_local_path
+        )
+
+        res = WebResource(self.archive,
+                          in_value,
+                          "text/html",
+                          self.archive.main_resource.url)
+        process_html_resource(res, self.output, "TestArchive_files")
+        self.assertEqual(self.output.getvalue(), out_value)
+
 
 class CSSRewriterTest(RewriterTest):
     """Test case for CSS-rewriting rules."""
 
-    def setUp(self):
-        """Set up the test case."""
+    @classmethod
+    def setUpClass(cls):
+        """Set up the test class."""
 
-        RewriterTest.setUp(self)
+        super().setUpClass()
 
         # URL for the dummy style sheet used by rewrite()
         # This doesn't actually have to exist.
-        self.dummy_css_url = "https://www.example.com/style.css"
+        cls.dummy_css_url = "https://www.example.com/style.css"
 
         # Override local paths that should now be relative to the style sheet,
         # not the main resource
-        self.subresource_local_path = (
-            self.archive.get_local_path(self.subresource_url)
+        cls.subresource_local_path = (
+            cls._sample_archive.get_local_path(cls.subresource_url)
         )
 
     def tearDown(self):
@@ -584,3 +845,57 @@ class CSSRewriterTest(RewriterTest):
 
         output = self.rewrite(in_value)
         self.assertEqual(output, out_value)
+
+    def test_rewrite_repeated(self):
+        """Test rewriting a URL that occurs more than once."""
+
+        # Each occurrence should be rewritten exactly once, not have the
+        # rewritten URL substituted again into earlier replacements
+        template = ('h1 {{ background: url({0}); }}\n'
+                    'h2 {{ background: url({0}); }}')
+        in_value = template.format(self.rel_external_url)
+        out_value = template.format(
+            self.archive._get_absolute_url(self.rel_external_url,
+                                           self.dummy_css_url)
+        )
+        self.assertNotEqual(in_value, out_value)
+
+        output = self.rewrite(in_value)
+        self.assertEqual(output, out_value)
+
+    def test_rewrite_quoted(self):
+        """Test rewriting quoted URLs."""
+
+        for quote in '"', "'":
+            template = 'html {{ background: url({0}{1}{0}); }}'
+            in_value = template.format(quote, self.subresource_url)
+            out_value = template.format(quote, self.subresource_local_path)
+            self.assertNotEqual(in_value, out_value)
+
+            output = self.rewrite(in_value)
+            self.assertEqual(output, out_value)
+
+    def test_rewrite_whitespace(self):
+        """Test rewriting URLs surrounded by whitespace."""
+
+        template = 'html {{ background: url( "{0}" ); }}'
+        in_value = template.format(self.subresource_url)
+        out_value = template.format(self.subresource_local_path)
+        self.assertNotEqual(in_value, out_value)
+
+        output = self.rewrite(in_value)
+        self.assertEqual(output, out_value)
+
+    def test_rewrite_parentheses(self):
+        """Test rewriting a quoted URL containing parentheses."""
+
+        template = 'html {{ background: url("{0}"); }}'
+        in_value = template.format("/images/example_(1).png")
+        out_value = template.format(
+            self.archive._get_absolute_url("/images/example_(1).png",
+                                           self.dummy_css_url)
+        )
+        self.assertNotEqual(in_value, out_value)
+
+        output = self.rewrite(in_value)
+        self.assertEqual(output, out_value)
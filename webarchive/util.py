@@ -3,20 +3,48 @@
 import io
 import re
 import html
+import functools
 
 from html.parser import HTMLParser
 from urllib.parse import urljoin
 
-from . import webresource
 from .exceptions import WebArchiveError
 
 
-__all__ = ["is_html_mime_type", "is_text_mime_type",
+__all__ = ["escape_attr_value", "is_html_mime_type", "is_text_mime_type",
            "process_css_resource", "process_html_resource"]
 
 
 # Regular expression matching a URL in a style sheet
-RX_STYLE_SHEET_URL = re.compile(r"url\(([^\)]+)\)")
+#
+# The URL itself is captured by one of three groups, depending on whether
+# it is enclosed in double quotes, single quotes, or no quotes at all.
+RX_STYLE_SHEET_URL = re.compile(
+    r"""url\(\s*(?:"([^"]*)"|'([^']*)'|([^\)\s]+))\s*\)"""
+)
+
+# Regular expression matching one image candidate in a srcset attribute
+#
+# The first group captures the URL, and the second captures its optional
+# descriptor (like "2x" or "100w"). Following the HTML standard, the URL
+# runs until the next whitespace and may itself contain commas, as data
+# URLs do; only commas at its very end separate it from the next candidate.
+RX_SRCSET_CANDIDATE = re.compile(
+    r"[\s,]*([^\s]*[^\s,])(?:,+|\s*([^,]*)(?:,|$))"
+)
+
+# Regular expression matching characters that must be escaped in HTML
+RX_HTML_SPECIAL_CHARS = re.compile(r"[&<>\"']")
+
+# Size in characters at which HTMLRewriter flushes its output buffer
+HTML_OUTPUT_BUFFER_SIZE = 262144
+
+# Regular expression matching anything in an HTML document that
+# HTMLRewriter might need to change: attributes that can contain URLs,
+# and inline style sheets. This is deliberately over-inclusive; a false
+# positive only means we process the document the slow way.
+RX_HTML_REWRITABLE = re.compile(r"\b(?:action|href|src|srcset)\s*=|<style",
+                                re.IGNORECASE)
 
 
 class HTMLRewriter(HTMLParser):
@@ -44,7 +72,9 @@ class HTMLRewriter(HTMLParser):
     # part of the page's content.
 
     __slots__ = ["_res", "_archive", "_output", "_subresource_dir",
-                 "_is_xhtml", "_style_buffer", "_in_style_block"]
+                 "_output_buffer", "_output_buffer_size", "_end_tags",
+                 "_resource_urls", "_is_xhtml",
+                 "_style_buffer", "_in_style_block"]
 
     def __init__(self, res, output, subresource_dir):
         """Return a new HTMLRewriter."""
@@ -56,25 +86,63 @@ class HTMLRewriter(HTMLParser):
         self._output = output
         self._subresource_dir = subresource_dir
 
+        # Buffer for rewritten code, so we can write it to the output
+        # stream in large chunks rather than a piece at a time
+        self._output_buffer = []
+        self._output_buffer_size = 0
+
+        # Formatted end tags, indexed by tag name
+        #
+        # A page uses only a few distinct tags, but closes them over and
+        # over, so it's worth reusing these strings rather than formatting
+        # them each time.
+        self._end_tags = {}
+
+        # Rewritten subresource URLs, indexed by original URL
+        #
+        # Pages often use the same image or script many times, and each
+        # lookup may involve resolving the URL or building a data URI.
+        self._resource_urls = {}
+
         # Identify whether this document is XHTML based on the MIME type
         self._is_xhtml = (res.mime_type == "application/xhtml+xml")
 
         # Buffer for processing inline CSS code
-        self._style_buffer = ""
+        self._style_buffer = []
         self._in_style_block = False
 
+    def feed(self, data):
+        """Feed data to the rewriter.
+
+        The rewritten code is written to the output stream before this
+        returns, so it is safe to inspect the stream afterward.
+        """
+
+        HTMLParser.feed(self, data)
+        self._flush_output()
+
+    def close(self):
+        """Process any remaining data and close the rewriter.
+
+        As with feed(), the rewritten code is written to the output
+        stream before this returns.
+        """
+
+        HTMLParser.close(self)
+        self._flush_output()
+
     def handle_starttag(self, tag, attrs):
         """Handle a start tag."""
 
         if tag == "style":
             self._in_style_block = True
 
-        self._output.write(self._build_starttag(tag, attrs))
+        self._write(self._build_starttag(tag, attrs))
 
     def handle_startendtag(self, tag, attrs):
         """Handle an XHTML-style "empty" start tag."""
 
-        self._output.write(self._build_starttag(tag, attrs, True))
+        self._write(self._build_starttag(tag, attrs, True))
 
     def handle_endtag(self, tag):
         """Handle an end tag."""
@@ -83,7 +151,12 @@ class HTMLRewriter(HTMLParser):
             self._in_style_block = False
             self._flush_style_buffer()
 
-        self._output.write("</{0}>".format(tag))
+        try:
+            end_tag = self._end_tags[tag]
+        except (KeyError):
+            end_tag = self._end_tags[tag] = "</{0}>".format(tag)
+
+        self._write(end_tag)
 
     def handle_data(self, data):
         """Handle arbitrary data."""
@@ -91,39 +164,61 @@ class HTMLRewriter(HTMLParser):
         if self._in_style_block:
             # Buffer inline CSS so we can rewrite URLs; this buffer will be
             # flushed when we close the tag
-            self._style_buffer = "".join((self._style_buffer, data))
+            self._style_buffer.append(data)
         else:
-            self._output.write(data)
+            self._write(data)
 
     def handle_entityref(self, name):
         """Handle a named character reference."""
 
-        self._output.write("&{0};".format(name))
+        self._write("&" + name + ";")
 
     def handle_charref(self, name):
         """Handle a numeric character reference."""
 
-        self._output.write("&#{0};".format(name))
+        self._write("&#" + name + ";")
 
     def handle_comment(self, data):
         """Handle a comment."""
 
         # Note IE conditional comments potentially can affect rendering
-        self._output.write("<!--{0}-->".format(data))
+        self._write("<!--" + data + "-->")
 
     def handle_decl(self, decl):
         """Handle a doctype declaration."""
 
-        self._output.write("<!{0}>".format(decl))
+        self._write("<!" + decl + ">")
 
         # This catches XHTML documents incorrectly served with an HTML type
         if "//DTD XHTML " in decl:
             self._is_xhtml = True
 
+    def _write(self, data):
+        """Write rewritten code to the output buffer."""
+
+        self._output_buffer.append(data)
+        self._output_buffer_size += len(data)
+        if self._output_buffer_size >= HTML_OUTPUT_BUFFER_SIZE:
+            self._flush_output()
+
+    def _flush_output(self):
+        """Write buffered code to the output stream."""
+
+        if self._output_buffer:
+            self._output.write("".join(self._output_buffer))
+            self._output_buffer.clear()
+            self._output_buffer_size = 0
+
     def _resource_url(self, orig_url):
         """Return an appropriate URL for the specified resource."""
 
-        return self._archive._get_local_url(self._subresource_dir, orig_url)
+        try:
+            return self._resource_urls[orig_url]
+        except (KeyError):
+            url = self._resource_urls[orig_url] = (
+                self._archive._get_local_url(self._subresource_dir, orig_url)
+            )
+            return url
 
     def _build_starttag(self, tag, attrs, is_empty=False):
         """Build an HTML start tag."""
@@ -133,22 +228,19 @@ class HTMLRewriter(HTMLParser):
 
         # Process attributes
         for attr, value in attrs:
-            tag_data.append(" ")
-            tag_data.append(attr)
             if value or value == "":
                 # The weird check is to catch empty string values as opposed
                 # to actual valueless attributes like iframe's "seamless"
-                tag_data.append('="')
-                tag_data.append(self._process_attr_value(tag, attr, value))
-                tag_data.append('"')
+                value = self._process_attr_value(tag, attr, value)
+                tag_data.append(' {0}="{1}"'.format(attr, value))
             elif self._is_xhtml:
                 # XHTML requires all attributes to have a value. This implies
                 # we should never reach this block in practice because any
                 # tag that omits a value is invalid, which would prevent the
                 # page from rendering in the first place.
-                tag_data.append('="')
-                tag_data.append(attr)
-                tag_data.append('"')
+                tag_data.append(' {0}="{0}"'.format(attr))
+            else:
+                tag_data.append(" {0}".format(attr))
 
         # Close the tag
         if self._is_xhtml and (is_empty or tag in self._VOID_ELEMENTS):
@@ -161,19 +253,23 @@ class HTMLRewriter(HTMLParser):
     def _flush_style_buffer(self):
         """Write out buffered inline CSS code."""
 
-        # Create a dummy WebResource to feed to process_css_resource()
-        css_res = webresource.WebResource(self._archive,
-                                          self._style_buffer,
-                                          "text/css",
-                                          self._res.url,
-                                          self._res.text_encoding)
+        # This writes directly to the output stream, so flush any code
+        # we've buffered to keep everything in the right order
+        self._flush_output()
 
-        process_css_resource(css_res, self._output, self._subresource_dir)
-        self._style_buffer = ""
+        # Inline CSS is resolved relative to the page containing it
+        _process_css_data(self._archive, self._res.url,
+                          "".join(self._style_buffer),
+                          self._output, self._subresource_dir)
+        self._style_buffer.clear()
 
     def _process_attr_value(self, tag, attr, value):
         """Process the value of a tag's attribute."""
 
+        # Most attributes can't contain URLs, so check for that first
+        if not attr in self._URL_ATTRIBUTES:
+            return escape_attr_value(value)
+
         if ((tag == "a" and attr == "href")
             or (tag == "form" and attr == "action")):
             # These always refer to content outside the WebArchive, which
@@ -192,19 +288,22 @@ class HTMLRewriter(HTMLParser):
         elif attr == "srcset":
             # Process the HTML5 srcset attribute
             srcset = []
-            for item in map(str.strip, value.split(",")):
-                if " " in item:
+            for match in RX_SRCSET_CANDIDATE.finditer(value):
+                src = self._resource_url(match.group(1))
+                size = match.group(2)
+                if size:
                     # Source-size pair, like "image.png 2x"
-                    src, size = item.split(" ", 1)
-                    src = self._resource_url(src)
-                    srcset.append("{0} {1}".format(src, size))
+                    srcset.append("{0} {1}".format(src, size.rstrip()))
                 else:
                     # Source only -- no size specified
-                    srcset.append(self._resource_url(item))
+                    srcset.append(src)
 
             value = ", ".join(srcset)
 
-        return html.escape(value, True)
+        return escape_attr_value(value)
+
+    # Attributes whose values _process_attr_value() might rewrite
+    _URL_ATTRIBUTES = frozenset(("action", "href", "src", "srcset"))
 
     # Valid self-closing tags (formally termed "void elements") in HTML
     # See: http://xahlee.info/js/html5_non-closing_tag.html
@@ -213,12 +312,39 @@ class HTMLRewriter(HTMLParser):
     # encounters such a tag, but in practice this does not always happen.
     # We thus check against this list of known self-closing tags to ensure
     # these are correctly closed when processing XHTML documents.
-    _VOID_ELEMENTS = (
+    #
+    # This is a frozenset since _build_starttag() checks every start tag
+    # in an XHTML document against it.
+    _VOID_ELEMENTS = frozenset((
         "area", "base", "br", "col", "embed", "hr", "img", "input", "link",
         "meta", "param", "source", "track", "wbr",
         # Obsolete tags
         "command", "keygen", "menuitem"
-    )
+    ))
+
+
+@functools.lru_cache(maxsize=4096)
+def _escape_short_attr_value(value):
+    """Cached version of escape_attr_value() for short values."""
+
+    return html.escape(value, True)
+
+
+def escape_attr_value(value):
+    """Escape the specified string for use as an HTML attribute value.
+
+    Pages tend to repeat the same short attribute values (class names,
+    language codes, and the like) many times, so results for these are
+    cached. Long values are rarely repeated and are escaped directly.
+    """
+
+    # Most values don't need escaping at all, which is quick to check
+    if not RX_HTML_SPECIAL_CHARS.search(value):
+        return value
+    elif len(value) <= 256:
+        return _escape_short_attr_value(value)
+    else:
+        return html.escape(value, True)
 
 
 def is_html_mime_type(mime_type):
@@ -253,27 +379,39 @@ def process_css_resource(res, output, subresource_dir=None):
     if res.mime_type != "text/css":
         raise TypeError("res must have mime_type == 'text/css'")
 
-    content = str(res)
+    _process_css_data(res.archive, res.url, str(res),
+                      output, subresource_dir)
 
-    # Find URLs in the stylesheet
-    for match in RX_STYLE_SHEET_URL.findall(content):
-        # Remove quote characters, if present, from the URL
-        if match.startswith('"') or match.startswith("'"):
-            match = match[1:]
-        if match.endswith('"') or match.endswith("'"):
-            match = match[:-1]
+
+def _process_css_data(archive, base_url, content, output, subresource_dir):
+    """Process a str containing CSS code.
+
+    This does the actual work for process_css_resource(). It is also
+    used directly for inline <style> blocks, which are already decoded
+    and have no WebResource of their own.
+    """
+
+    def rewrite_url(match):
+        # Rewrite a single url() value
+        group = match.lastindex
+        url = match.group(group)
 
         # This check is necessary because we sometimes get blank URLs
         # here, which can cause all manner of odd behavior
-        if match:
-            # URLs in CSS files are resolved relative to the style sheet
-            local_url = res.archive._get_local_url(subresource_dir,
-                                                   match,
-                                                   res.url)
-            if local_url != match:
-                content = content.replace(match, local_url)
+        if not url:
+            return match.group(0)
+
+        # URLs in CSS files are resolved relative to the style sheet
+        local_url = archive._get_local_url(subresource_dir, url, base_url)
 
-    output.write(content)
+        # Replace just the URL, keeping any quotes and whitespace around it
+        value = match.group(0)
+        start = match.start(group) - match.start()
+        end = match.end(group) - match.start()
+        return "".join((value[:start], local_url, value[end:]))
+
+    # Rewrite all the URLs in the style sheet in a single pass
+    output.write(RX_STYLE_SHEET_URL.sub(rewrite_url, content))
 
 
 def process_html_resource(res, output, subresource_dir):
@@ -297,15 +435,26 @@ def process_html_resource(res, output, subresource_dir):
         raise TypeError("res must have mime_type == "
                         "'text/html' or 'application/xhtml+xml'")
 
+    content = str(res)
+
+    # If a plain HTML document has nothing HTMLRewriter would change,
+    # skip parsing it altogether. (XHTML documents are always processed,
+    # since HTMLRewriter also closes their void elements.)
+    if (res.mime_type == "text/html"
+        and "//DTD XHTML " not in content
+        and not RX_HTML_REWRITABLE.search(content)):
+        output.write(content)
+        return
+
     try:
         # Feed the content through the HTMLRewriter to rewrite
         # references to files inside the archive
         rewriter = HTMLRewriter(res, output, subresource_dir)
-        rewriter.feed(str(res))
+        rewriter.feed(content)
 
     except (Exception):
         # This may indicate a non-HTML resource incorrectly served
         # with a text/html MIME type. Clear the botched attempt and
         # pass through the original data unmodified
         output.truncate(0)
-        output.write(str(res))
+        output.write(content)
@@ -4,8 +4,9 @@ import os
 import io
 import plistlib
 import mimetypes
+import collections
 
-from urllib.parse import urlparse, urljoin
+from urllib.parse import urlsplit, urljoin
 
 from .exceptions import WebArchiveError
 from .webresource import WebResource
@@ -16,6 +17,24 @@ from .util import (is_html_mime_type,
 __all__ = ["WebArchive"]
 
 
+# These are common file extensions for web content
+# that the mimetypes module may not already know
+#
+# We check these ourselves rather than registering them with mimetypes,
+# since doing so would load the system's MIME type database on import.
+WEB_MIME_TYPE_EXTENSIONS = {
+    "application/font-woff": ".woff",
+    "application/x-font-woff": ".woff",
+    "application/x-javascript": ".js",
+    "font/woff": ".woff",
+    "font/woff2": ".woff2",
+    "text/javascript": ".js",
+}
+
+# Maximum number of subresources to extract simultaneously
+EXTRACT_THREADS = min(32, (os.cpu_count() or 1) + 4)
+
+
 class WebArchive(object):
     """An archive storing a webpage's content and embedded external media.
 
@@ -43,7 +62,8 @@ class WebArchive(object):
 
     __slots__ = ["_parent",
                  "_main_resource", "_subresources", "_subframe_archives",
-                 "_local_paths"]
+                 "_subresources_by_url",
+                 "_local_paths", "_used_local_paths", "_absolute_urls"]
 
     def __init__(self, parent=None):
         """Return a new WebArchive object.
@@ -58,6 +78,9 @@ class WebArchive(object):
         self._subresources = []
         self._subframe_archives = []
 
+        # The same subresources, indexed by URL for get_subresource()
+        self._subresources_by_url = {}
+
         # Basenames for extracted subresources, indexed by (absolute) URL
         #
         # This also contains entries for the main resources, but not
@@ -67,6 +90,15 @@ class WebArchive(object):
         # can be extracted independently of its parent archive.
         self._local_paths = {}
 
+        # The same basenames as a set, for quickly checking uniqueness
+        self._used_local_paths = set()
+
+        # Cache of resolved absolute URLs, indexed by (base, url)
+        #
+        # Pages often refer to the same resource many times, and urljoin()
+        # is relatively expensive, so it's worth remembering its results.
+        self._absolute_urls = {}
+
     def __del__(self):
         """Clean up before deleting this object."""
 
@@ -122,12 +154,13 @@ class WebArchive(object):
         can specify callback functions for the following keyword arguments:
 
           before_cb(res, path)
-            Called just before extracting a WebResource. No return value.
+            Called when a WebResource is about to be extracted.
+            No return value.
             - res is the WebResource object to be extracted.
             - path is the absolute path where it will be extracted.
 
           after_cb(res, path)
-            Called just after extracting a WebResource. No return value.
+            Called after a WebResource has been extracted. No return value.
             - res is the WebResource object that was extracted.
             - path is the absolute path where it was extracted.
 
@@ -135,13 +168,22 @@ class WebArchive(object):
             Called periodically to check if extraction was canceled
             by the user. Should return True to cancel, False otherwise.
 
+        All callbacks are called from the thread that called extract().
+        When extracting to separate files, subresources are written by a
+        pool of up to EXTRACT_THREADS worker threads, so before_cb may
+        run for several resources before after_cb runs for the first.
+        Each resource still gets exactly one before_cb and one after_cb
+        call, and after_cb calls come in the same order as before_cb.
+
+        If extraction is canceled, no further resources are started, but
+        any already passed to before_cb are finished (and passed to
+        after_cb) before this returns, so no partially-written files are
+        left behind.
+
         If an error occurs during extraction, this will raise a
         WebArchiveError with a message explaining what went wrong.
         """
 
-        # Note: _extract_main_resource() checks that an archive actually
-        # has a main resource, and raises an exception if it's missing.
-
         # The embed_subresources argument was previously named single_file.
         # Since it is intended to be used as a positional rather than a
         # keyword argument, I think this is an acceptable change to provide
@@ -149,6 +191,10 @@ class WebArchive(object):
         # backwards compatibility for any code passing single_file as a
         # keyword argument against our intentions.
 
+        # Fail before calling any callbacks or touching the filesystem
+        if not self._main_resource:
+            raise WebArchiveError("archive does not have a main resource")
+
         if canceled_cb and canceled_cb():
             return
 
@@ -183,6 +229,11 @@ class WebArchive(object):
             subresource_dir = os.path.join(os.path.dirname(output_path),
                                            subresource_dir_base)
 
+            # Prefix for paths to individual subresources
+            # (local paths are plain basenames, so we can just concatenate
+            # them with this rather than calling os.path.join() each time)
+            subresource_prefix = subresource_dir + os.sep
+
             # Extract the main resource
             BEFORE(self._main_resource, output_path)
             self._extract_main_resource(output_path, subresource_dir_base)
@@ -193,18 +244,53 @@ class WebArchive(object):
                 os.makedirs(subresource_dir, exist_ok=True)
 
             # Extract subresources
-            for res in self._subresources:
-                # Full path to the extracted subresource
-                subresource_path = os.path.join(subresource_dir,
-                                                self._local_paths[res.url])
-
-                if canceled_cb and canceled_cb():
-                    return
-
-                # Extract this subresource
-                BEFORE(res, subresource_path)
-                self._extract_subresource(res, subresource_path)
-                AFTER(res, subresource_path)
+            #
+            # This is mostly waiting on I/O, so we can save time by writing
+            # several files at once using a thread pool. Callbacks are still
+            # run from this thread, in order, so callers don't have to
+            # worry about thread safety.
+            #
+            # (This is imported here because it takes longer to import than
+            # the rest of this module, and many applications may not need it.)
+            from concurrent.futures import ThreadPoolExecutor
+
+            canceled = False
+            with ThreadPoolExecutor(EXTRACT_THREADS) as executor:
+                # Subresources currently being extracted
+                in_progress = collections.deque()
+
+                def finish_oldest():
+                    # Wait for the oldest extraction in progress to finish
+                    res, subresource_path, future = in_progress.popleft()
+                    future.result()
+                    AFTER(res, subresource_path)
+
+                for res in self._subresources:
+                    # Full path to the extracted subresource
+                    subresource_path = (subresource_prefix
+                                        + self._local_paths[res.url])
+
+                    if canceled_cb and canceled_cb():
+                        canceled = True
+                        break
+
+                    # Extract this subresource
+                    BEFORE(res, subresource_path)
+                    future = executor.submit(self._extract_subresource,
+                                             res, subresource_path)
+                    in_progress.append((res, subresource_path, future))
+
+                    # Don't get too far ahead of the thread pool
+                    if len(in_progress) >= EXTRACT_THREADS:
+                        finish_oldest()
+
+                # Finish any extractions still in progress, even if we were
+                # canceled, so we don't leave partially-written files behind
+                while in_progress:
+                    finish_oldest()
+
+            if canceled:
+                return
 
             # Recursively extract subframe archives
             for subframe_archive in self._subframe_archives:
@@ -215,8 +301,8 @@ class WebArchive(object):
                     return
 
                 sf_main = subframe_archive._main_resource
-                sf_local_path = os.path.join(subresource_dir,
-                                             self._local_paths[sf_main.url])
+                sf_local_path = (subresource_prefix
+                                 + self._local_paths[sf_main.url])
 
                 subframe_archive.extract(sf_local_path,
                                          embed_subresources,
@@ -266,10 +352,9 @@ class WebArchive(object):
         if not "://" in url:
             raise WebArchiveError("must specify an absolute URL")
 
-        for subresource in self._subresources:
-            if subresource.url == url:
-                return subresource
-        else:
+        try:
+            return self._subresources_by_url[url]
+        except (KeyError):
             raise WebArchiveError("no subresource for the specified URL")
 
     def resource_count(self):
@@ -320,7 +405,7 @@ class WebArchive(object):
             # Non-HTML main resources are possible; for example, I have
             # one from YouTube where the main resource is JavaScript.
             with io.open(output_path, "wb") as output:
-                output.write(bytes(main_resource))
+                output.write(main_resource.data)
 
     def _extract_subresource(self, res, output_path):
         """Extract the specified subresource from the archive."""
@@ -341,8 +426,12 @@ class WebArchive(object):
 
         else:
             # Extract other subresources as-is
+            #
+            # We write the resource's data directly since the file object
+            # accepts any bytes-like object, and converting it to bytes
+            # would make a copy if the data is stored some other way.
             with io.open(output_path, "wb") as output:
-                output.write(bytes(res))
+                output.write(res.data)
 
     def _get_absolute_url(self, url, base=None):
         """Return the absolute URL to the specified resource.
@@ -358,7 +447,12 @@ class WebArchive(object):
         elif not "://" in base:
             raise WebArchiveError("base must be an absolute URL")
 
-        return urljoin(base, url)
+        key = (base, url)
+        try:
+            return self._absolute_urls[key]
+        except (KeyError):
+            abs_url = self._absolute_urls[key] = urljoin(base, url)
+            return abs_url
 
     def _get_local_url(self, subresource_dir, orig_url, base=None):
         """Return a (preferably local) URL for the specified resource.
@@ -382,6 +476,16 @@ class WebArchive(object):
         from if subresource_dir is None, which returns a data URI.
         """
 
+        if subresource_dir is not None and orig_url in self._local_paths:
+            # Pages usually reference subresources by the same absolute
+            # URL the archive stores them under, so we can skip resolving
+            # orig_url and look up its local path directly
+            local_path = self._local_paths[orig_url]
+            if subresource_dir:
+                return "{0}/{1}".format(subresource_dir, local_path)
+            else:
+                return local_path
+
         # Get the absolute URL of the original resource
         abs_url = self._get_absolute_url(orig_url, base)
 
@@ -411,16 +515,22 @@ class WebArchive(object):
 
         if res.url:
             # Parse the resource's URL
-            parsed_url = urlparse(res.url)
+            parsed_url = urlsplit(res.url)
 
             if parsed_url.scheme == "data":
                 # Data URLs are anonymous, so assign a default basename
                 base = "data_url"
 
             else:
-                # Get the basename of the URL path
-                url_path_basename = os.path.basename(parsed_url.path)
-                base, ext = os.path.splitext(url_path_basename)
+                # Get the last segment of the URL path, minus any
+                # parameters (as in "/page.jsp;jsessionid=...")
+                base = parsed_url.path.rpartition("/")[2].partition(";")[0]
+
+                # Strip its extension. As with os.path.splitext(), dots
+                # at the start of the name don't count as an extension.
+                dot = base.rfind(".")
+                if dot > 0 and base[:dot].lstrip("."):
+                    base = base[:dot]
 
         if not base:
             # No URL, or blank URL path (why would this occur?)
@@ -431,7 +541,8 @@ class WebArchive(object):
         # data they contain. However, local files don't have HTTP headers,
         # so browsers rely on file extensions to determine their types.
         # We should thus choose extensions they'll be likely to recognize.
-        ext = mimetypes.guess_extension(res.mime_type)
+        ext = (WEB_MIME_TYPE_EXTENSIONS.get(res.mime_type)
+               or mimetypes.guess_extension(res.mime_type))
         if not ext:
             ext = ""
 
@@ -457,12 +568,13 @@ class WebArchive(object):
 
         # Append a copy number if needed to ensure a unique basename
         copy_num = 1
-        while local_path in self._local_paths.values():
+        while local_path in self._used_local_paths:
             copy_num += 1
             local_path = "{0}.{1}{2}".format(base, copy_num, ext)
 
         # Save this resource's local path
         self._local_paths[res.url] = local_path
+        self._used_local_paths.add(local_path)
         return local_path
 
     def _make_local_paths(self):
@@ -507,6 +619,10 @@ class WebArchive(object):
                 res = WebResource._create_from_plist_data(res_data, self)
                 self._subresources.append(res)
 
+                # If a URL somehow appears twice, keep the first resource
+                # as a linear search through self._subresources would
+                self._subresources_by_url.setdefault(res.url, res)
+
         # Process subframe archives
         if "WebSubframeArchives" in archive_data:
             for sa_data in archive_data["WebSubframeArchives"]:
@@ -592,12 +708,3 @@ class WebArchive(object):
 
         return self._subframe_archives
 
-
-# These are common file extensions for web content
-# that the mimetypes module may not already know
-mimetypes.add_type("application/font-woff", ".woff")
-mimetypes.add_type("application/x-font-woff", ".woff")
-mimetypes.add_type("application/x-javascript", ".js")
-mimetypes.add_type("font/woff", ".woff")
-mimetypes.add_type("font/woff2", ".woff2")
-mimetypes.add_type("text/javascript", ".js")